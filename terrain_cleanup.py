@@ -1,12 +1,36 @@
+import math
 from typing import Literal
 
 import bpy
 import bmesh
 import bpy_types
-from mathutils import Vector
+import numpy as np
+from mathutils import Matrix, Vector
 
 from mathutils.bvhtree import BVHTree
 
+try:
+    from embreex import rtcore_scene
+    from embreex.mesh_construction import TriangleMesh
+    embree_available = True
+except ImportError:
+    # Embree is not shipped with blender as well, it is used instead of the BVHTree if installed
+    embree_available = False
+
+try:
+    from numba import njit, prange
+    numba_available = True
+except ImportError:
+    # Numba is not shipped with blender, without it the rays get cast with Embree, the height grid or the BVHTree
+    numba_available = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        # Dummy decorator, the compiled functions only get called if numba is available
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
 """
 HOW TO USE
     Open the text editor in blender and create a new file. Copy and paste this whole script and modify the settings 
@@ -29,12 +53,23 @@ SKIP_EDGES:
     Does not delete the edges of the model (only works for rectangular models)
 EDGE_MARGIN:
     The threshold for the edges 
+USE_EMBREE:
+    If embreex is installed into the python of blender, the rays get cast with Embree. Embreex traces the rays one after
+    another on a single cpu core, so it is only used if numba is not available. Only used if debug is disabled. If
+    embreex is not installed, this setting has no effect
+USE_HEIGHT_GRID:
+    In vertical mode, the rays get cast with NumPy against a 2D grid of the triangles instead of a BVH. Used if neither
+    numba nor Embree are available, only used if debug is disabled
+USE_NUMBA:
+    If numba is installed into the python of blender, the rays get cast by a compiled kernel that uses all cpu cores.
+    Takes precedence over all other backends, only used if debug is disabled. If numba is not installed, this setting
+    has no effect
 Debug:
     If enabled, the mesh will not get modified. All faces that get hit by a ray of a selected face will get selected.
 Debug objects:
-    If enabled on top of "Debug", the script additionally spawns primitives at the relevant positions:
+    If enabled on top of "Debug", the script additionally creates one object with primitives at the relevant positions:
     
-    Default cube: Starting point of ray
+    Cube: Starting point of ray
     Icosphere: Starting point of ray + direction
     Torus: Intersecting point of ray
 """
@@ -43,6 +78,9 @@ RAY_LENGTH = 400
 ONLY_SELECTED_FACES = False
 SKIP_EDGES = True
 EDGE_MARGIN = 0.5
+USE_EMBREE = True
+USE_HEIGHT_GRID = True
+USE_NUMBA = True
 # Debug settings
 DEBUG = False
 DEBUG_OBJECTS = False
@@ -88,99 +126,622 @@ if SKIP_EDGES:
     log("Bounding box:", lower_bound, upper_bound)
 
 
-def is_edge(v: Vector):
-    if (v.x - EDGE_MARGIN <= lower_bound.x or v.x + EDGE_MARGIN >= upper_bound.x or
-            v.y - EDGE_MARGIN <= lower_bound.y or v.y + EDGE_MARGIN >= upper_bound.y or
-            v.z - EDGE_MARGIN <= lower_bound.z):
-        return True
+def is_edge(co: np.ndarray) -> np.ndarray:
+    """Returns a boolean mask of all positions (world coordinates, shape (N, 3)) that lie on the edge of the mesh"""
+    return ((co[:, 0] - EDGE_MARGIN <= lower_bound.x) | (co[:, 0] + EDGE_MARGIN >= upper_bound.x) |
+            (co[:, 1] - EDGE_MARGIN <= lower_bound.y) | (co[:, 1] + EDGE_MARGIN >= upper_bound.y) |
+            (co[:, 2] - EDGE_MARGIN <= lower_bound.z))
+
+
+def delete_faces(bmesh_obj: bmesh.types.BMesh, faces: list):
+    """Deletes all given faces with one single operation"""
+    if len(faces) == 0:
+        return
+    bmesh.ops.delete(bmesh_obj, geom=faces, context="FACES")
+
+
+def mesh_triangles(mesh_obj: bpy_types.Mesh):
+    """Returns the vertex coordinates (shape (N, 3)), the vertex indices of all triangles (shape (M, 3)) and the index
+    of the face every triangle belongs to (shape (M,)) of the mesh. All arrays use 32 bit types, the precision blender
+    stores the mesh with, so the ray casting backends can use them without any conversion. The loop triangles are the
+    triangulation blender caches for the mesh, so none of the backends has to triangulate faces itself. Degenerated
+    triangles (without area) are skipped, no ray can hit them"""
+    mesh_obj.calc_loop_triangles()
+    verts = np.empty((len(mesh_obj.vertices), 3), dtype=np.float32)
+    mesh_obj.vertices.foreach_get("co", verts.ravel())
+    tris = np.empty((len(mesh_obj.loop_triangles), 3), dtype=np.int32)
+    mesh_obj.loop_triangles.foreach_get("vertices", tris.ravel())
+    tri_faces = np.empty(len(mesh_obj.loop_triangles), dtype=np.int32)
+    mesh_obj.loop_triangles.foreach_get("polygon_index", tri_faces)
+    normals = np.cross(verts[tris[:, 1]] - verts[tris[:, 0]], verts[tris[:, 2]] - verts[tris[:, 0]])
+    valid = np.any(normals != 0, axis=1)
+    return verts, tris[valid], tri_faces[valid]
+
+
+BVH_LEAF_SIZE = 4
+BVH_STACK_SIZE = 64
+KERNEL_CHUNK_SIZE = 4096
+
+
+@njit
+def _build_bvh(verts, tris):
+    """Builds a bounding volume hierarchy over the triangles by splitting at the median centroid. The nodes are stored
+    as flat arrays: The bounding box (node_min, node_max), the child nodes (node_left, node_right, -1 for leafs) and the
+    range of triangles of leaf nodes (node_start, node_count) inside prim_idx"""
+    count_tris = tris.shape[0]
+    tri_min = np.empty((count_tris, 3), dtype=np.float32)
+    tri_max = np.empty((count_tris, 3), dtype=np.float32)
+    centroids = np.empty((count_tris, 3), dtype=np.float32)
+    for t in range(count_tris):
+        for k in range(3):
+            a = verts[tris[t, 0], k]
+            b = verts[tris[t, 1], k]
+            c = verts[tris[t, 2], k]
+            tri_min[t, k] = min(a, b, c)
+            tri_max[t, k] = max(a, b, c)
+            centroids[t, k] = (a + b + c) / 3
+
+    max_nodes = max(2 * count_tris - 1, 1)
+    node_min = np.zeros((max_nodes, 3), dtype=np.float32)
+    node_max = np.zeros((max_nodes, 3), dtype=np.float32)
+    node_left = np.full(max_nodes, -1, dtype=np.int32)
+    node_right = np.full(max_nodes, -1, dtype=np.int32)
+    node_start = np.zeros(max_nodes, dtype=np.int32)
+    node_count = np.zeros(max_nodes, dtype=np.int32)
+    prim_idx = np.arange(count_tris).astype(np.int32)
+
+    # Nodes that still have to be processed: (node, first triangle, last triangle + 1)
+    stack = np.empty((BVH_STACK_SIZE, 3), dtype=np.int64)
+    stack[0, 0], stack[0, 1], stack[0, 2] = 0, 0, count_tris
+    sp = 1
+    nodes_used = 1
+    while sp > 0:
+        sp -= 1
+        node, start, end = stack[sp, 0], stack[sp, 1], stack[sp, 2]
+        c_min = np.full(3, np.inf)
+        c_max = np.full(3, -np.inf)
+        for k in range(3):
+            node_min[node, k] = np.inf
+            node_max[node, k] = -np.inf
+        for p in range(start, end):
+            t = prim_idx[p]
+            for k in range(3):
+                node_min[node, k] = min(node_min[node, k], tri_min[t, k])
+                node_max[node, k] = max(node_max[node, k], tri_max[t, k])
+                c_min[k] = min(c_min[k], centroids[t, k])
+                c_max[k] = max(c_max[k], centroids[t, k])
+        axis = np.argmax(c_max - c_min)
+        if end - start <= BVH_LEAF_SIZE or c_max[axis] - c_min[axis] <= 0:
+            node_start[node] = start
+            node_count[node] = end - start
+            continue
+        # Sorting the triangles of this node along the longest axis and splitting them in half
+        keys = np.empty(end - start, dtype=np.float32)
+        for p in range(start, end):
+            keys[p - start] = centroids[prim_idx[p], axis]
+        prim_idx[start:end] = prim_idx[start:end][np.argsort(keys)]
+        mid = start + (end - start) // 2
+        node_left[node] = nodes_used
+        node_right[node] = nodes_used + 1
+        nodes_used += 2
+        stack[sp, 0], stack[sp, 1], stack[sp, 2] = node_left[node], start, mid
+        stack[sp + 1, 0], stack[sp + 1, 1], stack[sp + 1, 2] = node_right[node], mid, end
+        sp += 2
+    return node_min, node_max, node_left, node_right, node_start, node_count, prim_idx
+
+
+@njit
+def _ray_aabb(orig, inv_x, inv_y, inv_z, b_min, b_max):
+    """Returns the distance at which the ray enters the box or infinity if it misses the box"""
+    t1 = (b_min[0] - orig[0]) * inv_x
+    t2 = (b_max[0] - orig[0]) * inv_x
+    t_near = min(t1, t2)
+    t_far = max(t1, t2)
+    t1 = (b_min[1] - orig[1]) * inv_y
+    t2 = (b_max[1] - orig[1]) * inv_y
+    t_near = max(t_near, min(t1, t2))
+    t_far = min(t_far, max(t1, t2))
+    t1 = (b_min[2] - orig[2]) * inv_z
+    t2 = (b_max[2] - orig[2]) * inv_z
+    t_near = max(t_near, min(t1, t2))
+    t_far = min(t_far, max(t1, t2))
+    if t_far < max(t_near, 0.0):
+        return np.inf
+    return t_near
+
+
+@njit
+def _ray_triangle(orig, direction, v0, v1, v2):
+    """Moeller-Trumbore intersection, returns the distance to the triangle or -1 if the ray misses it"""
+    e1x, e1y, e1z = v1[0] - v0[0], v1[1] - v0[1], v1[2] - v0[2]
+    e2x, e2y, e2z = v2[0] - v0[0], v2[1] - v0[1], v2[2] - v0[2]
+    px = direction[1] * e2z - direction[2] * e2y
+    py = direction[2] * e2x - direction[0] * e2z
+    pz = direction[0] * e2y - direction[1] * e2x
+    det = e1x * px + e1y * py + e1z * pz
+    if abs(det) < 1e-12:
+        return -1.0
+    inv_det = 1.0 / det
+    tx, ty, tz = orig[0] - v0[0], orig[1] - v0[1], orig[2] - v0[2]
+    u = (tx * px + ty * py + tz * pz) * inv_det
+    if u < 0.0 or u > 1.0:
+        return -1.0
+    qx = ty * e1z - tz * e1y
+    qy = tz * e1x - tx * e1z
+    qz = tx * e1y - ty * e1x
+    v = (direction[0] * qx + direction[1] * qy + direction[2] * qz) * inv_det
+    if v < 0.0 or u + v > 1.0:
+        return -1.0
+    return (e2x * qx + e2y * qy + e2z * qz) * inv_det
+
+
+@njit
+def _ray_hits_bvh(orig, direction, max_dist, stack, verts, tris, node_min, node_max, node_left, node_right,
+                  node_start, node_count, prim_idx):
+    """Returns True if the ray hits any triangle within the given distance. The stack array is only used as scratch
+    memory for the traversal"""
+    inv_x = 1.0 / direction[0] if direction[0] != 0 else 1e30
+    inv_y = 1.0 / direction[1] if direction[1] != 0 else 1e30
+    inv_z = 1.0 / direction[2] if direction[2] != 0 else 1e30
+    stack[0] = 0
+    sp = 1
+    while sp > 0:
+        sp -= 1
+        node = stack[sp]
+        if _ray_aabb(orig, inv_x, inv_y, inv_z, node_min[node], node_max[node]) > max_dist:
+            continue
+        if node_left[node] < 0:
+            for p in range(node_start[node], node_start[node] + node_count[node]):
+                t = prim_idx[p]
+                dist = _ray_triangle(orig, direction, verts[tris[t, 0]], verts[tris[t, 1]], verts[tris[t, 2]])
+                if 0.0 < dist <= max_dist:
+                    return True
+        else:
+            stack[sp] = node_left[node]
+            stack[sp + 1] = node_right[node]
+            sp += 2
     return False
 
 
+@njit(parallel=True)
+def _cast_rays_kernel(origins, directions, max_dist, verts, tris, node_min, node_max, node_left, node_right,
+                      node_start, node_count, prim_idx):
+    count = origins.shape[0]
+    hit = np.zeros(count, dtype=np.uint8)
+    # The rays are processed in chunks, so the traversal stack is only allocated once per chunk and not for every ray
+    for chunk in prange((count + KERNEL_CHUNK_SIZE - 1) // KERNEL_CHUNK_SIZE):
+        stack = np.empty(BVH_STACK_SIZE, dtype=np.int32)
+        for i in range(chunk * KERNEL_CHUNK_SIZE, min((chunk + 1) * KERNEL_CHUNK_SIZE, count)):
+            direction = directions[i] if directions.shape[0] > 1 else directions[0]
+            if _ray_hits_bvh(origins[i], direction, max_dist, stack, verts, tris, node_min, node_max, node_left,
+                             node_right, node_start, node_count, prim_idx):
+                hit[i] = 1
+    return hit
+
+
+def cast_rays_numba(origins: np.ndarray, directions: np.ndarray, verts: np.ndarray, tris: np.ndarray) -> np.ndarray:
+    """Casts all rays in parallel and returns a mask (uint8) of all rays that hit the mesh. Directions must be unit
+    length and either have the same shape as origins or contain a single direction used for all rays"""
+    if len(tris) == 0 or len(origins) == 0:
+        return np.zeros(len(origins), dtype=np.uint8)
+    bvh = _build_bvh(verts, tris)
+    return _cast_rays_kernel(origins, directions.astype(np.float32, copy=False), float(RAY_LENGTH), verts, tris, *bvh)
+
+
+def cast_rays_embree(origins: np.ndarray, directions: np.ndarray, verts: np.ndarray, tris: np.ndarray) -> np.ndarray:
+    """Casts all rays with Embree and returns a mask (uint8) of all rays that hit the mesh. Directions must be unit
+    length and either have the same shape as origins or contain a single direction used for all rays"""
+    if len(tris) == 0 or len(origins) == 0:
+        return np.zeros(len(origins), dtype=np.uint8)
+    scene = rtcore_scene.EmbreeScene()
+    TriangleMesh(scene, np.ascontiguousarray(verts, dtype=np.float32), np.ascontiguousarray(tris, dtype=np.int32))
+    directions = np.ascontiguousarray(np.broadcast_to(directions, origins.shape), dtype=np.float32)
+    dists = np.full(len(origins), RAY_LENGTH, dtype=np.float32)
+    # Only the information whether a ray hits anything is needed, occlusion queries skip searching the closest hit
+    hit_ids = scene.run(np.ascontiguousarray(origins, dtype=np.float32), directions, dists=dists, query="OCCLUDED")
+    return (hit_ids != -1).astype(np.uint8)
+
+
+def _add_torus(bm_debug: bmesh.types.BMesh, center: Vector, major_radius=0.5, minor_radius=0.25, major_segments=24,
+               minor_segments=8):
+    # Bmesh has no operator for tori
+    rings = []
+    for i in range(major_segments):
+        u = 2 * math.pi * i / major_segments
+        ring = []
+        for j in range(minor_segments):
+            v = 2 * math.pi * j / minor_segments
+            r = major_radius + minor_radius * math.cos(v)
+            ring.append(bm_debug.verts.new((center.x + r * math.cos(u), center.y + r * math.sin(u),
+                                            center.z + minor_radius * math.sin(v))))
+        rings.append(ring)
+    for i in range(major_segments):
+        ring, next_ring = rings[i], rings[(i + 1) % major_segments]
+        for j in range(minor_segments):
+            k = (j + 1) % minor_segments
+            bm_debug.faces.new((ring[j], next_ring[j], next_ring[k], ring[k]))
+
+
+def create_debug_object(name: str):
+    """Creates one object containing all debug primitives (world coordinates). Building the geometry directly is much
+    faster than calling the primitive operators for every single primitive"""
+    bm_debug = bmesh.new()
+    for pos in debug_cubes:
+        bmesh.ops.create_cube(bm_debug, size=0.5, matrix=Matrix.Translation(mat @ pos))
+    for pos in debug_spheres:
+        bmesh.ops.create_icosphere(bm_debug, subdivisions=2, radius=0.2, matrix=Matrix.Translation(mat @ pos))
+    for pos in debug_tori:
+        _add_torus(bm_debug, mat @ pos)
+    debug_mesh = bpy.data.meshes.new(name)
+    bm_debug.to_mesh(debug_mesh)
+    bm_debug.free()
+    bpy.context.collection.objects.link(bpy.data.objects.new(name, debug_mesh))
+
+
+def is_upwards(direction: np.ndarray) -> bool:
+    """Checks if the direction (local coordinates) points straight along the z-axis"""
+    return direction[2] > 0 and np.all(np.abs(direction[:2]) <= 1e-6 * np.linalg.norm(direction))
+
+
+def _triangle_cells(verts: np.ndarray, tris: np.ndarray):
+    """Bins the triangles into a 2D grid (XY plane) with cells of about the size of the triangles. Returns the grid
+    origin, the cell size, the grid shape, the first and last cell (x, y) every triangle overlaps and the highest point
+    of every triangle"""
+    tri_min = np.minimum(np.minimum(verts[tris[:, 0]], verts[tris[:, 1]]), verts[tris[:, 2]])
+    tri_max = np.maximum(np.maximum(verts[tris[:, 0]], verts[tris[:, 1]]), verts[tris[:, 2]])
+    xy_min = tri_min[:, :2].min(axis=0)
+    extent = np.maximum(tri_max[:, :2].max(axis=0) - xy_min, 1e-6)
+    # The cells should be about the size of the triangles, but the grid should not get larger than the mesh itself.
+    # The grid starts at the lowest vertex, so for grid aligned meshes (e.g. voxels) the cell borders match the edges
+    cell_size = max(float(np.median((tri_max[:, :2] - tri_min[:, :2]).max(axis=1))),
+                    math.sqrt(extent[0] * extent[1] / len(tris)))
+    shape = (extent / cell_size).astype(np.int64) + 1
+    cell_min = np.floor((tri_min[:, :2] - xy_min) / cell_size).astype(np.int64)
+    # A triangle ending exactly on a cell border does not get added to the next cell, _ray_cells checks both cells
+    # for rays starting on a border instead
+    cell_max = np.ceil((tri_max[:, :2] - xy_min) / cell_size).astype(np.int64) - 1
+    cell_max = np.clip(cell_max, cell_min, shape - 1)
+    return xy_min, cell_size, shape, cell_min, cell_max, tri_max[:, 2]
+
+
+def _ray_cells(origins: np.ndarray, xy_min: np.ndarray, cell_size: float, shape: np.ndarray):
+    """Returns the lowest and highest cell (x, y) of the grid that contain the origin of the rays. Both are the same,
+    unless the origin lies exactly on a cell border. Also returns a mask of the origins outside the grid"""
+    pos = (origins[:, :2] - xy_min) / cell_size
+    cell_high = np.floor(pos).astype(np.int64)
+    cell_low = np.ceil(pos).astype(np.int64) - 1
+    outside = np.any((cell_high < 0) | (cell_low >= shape), axis=1)
+    cell_high = np.clip(cell_high, 0, shape - 1)
+    cell_low = np.clip(np.minimum(cell_low, cell_high), 0, shape - 1)
+    return cell_low, cell_high, outside
+
+
+def cull_vertical_rays(origins: np.ndarray, verts: np.ndarray, tris: np.ndarray) -> np.ndarray:
+    """Returns a mask of all upward rays that might hit a triangle. The triangles get binned into a 2D grid that stores
+    the highest point of all triangles overlapping a cell, rays starting above the highest point can not hit anything"""
+    if len(tris) == 0:
+        return np.zeros(len(origins), dtype=bool)
+    xy_min, cell_size, shape, cell_min, cell_max, z_max = _triangle_cells(verts, tris)
+    grid = np.full(shape, -np.inf, dtype=np.float32)
+    # Most triangles overlap at most 2x2 cells, these are written for all triangles at once
+    small = np.all(cell_max - cell_min <= 1, axis=1)
+    for cx in (cell_min[small, 0], cell_max[small, 0]):
+        for cy in (cell_min[small, 1], cell_max[small, 1]):
+            np.maximum.at(grid, (cx, cy), z_max[small])
+    for t in np.flatnonzero(~small):
+        cells = grid[cell_min[t, 0]:cell_max[t, 0] + 1, cell_min[t, 1]:cell_max[t, 1] + 1]
+        np.maximum(cells, z_max[t], out=cells)
+    cell_low, cell_high, outside = _ray_cells(origins, xy_min, cell_size, shape)
+    highest = np.maximum(np.maximum(grid[cell_low[:, 0], cell_low[:, 1]], grid[cell_low[:, 0], cell_high[:, 1]]),
+                         np.maximum(grid[cell_high[:, 0], cell_low[:, 1]], grid[cell_high[:, 0], cell_high[:, 1]]))
+    return ~outside & (origins[:, 2] <= highest)
+
+
+# Maximum number of ray-triangle pairs that get tested at once by cast_rays_grid (unless a single cell contains more)
+GRID_CHUNK_SIZE = 2_000_000
+# The height grid is not used if the rays test more triangles than this factor times the average of the cells
+GRID_MAX_DENSITY_FACTOR = 16
+
+
+def _vertical_hits(origins: np.ndarray, verts: np.ndarray, tris: np.ndarray) -> np.ndarray:
+    """Tests pairs of upward rays and triangles, returns a mask of all pairs where the ray hits the triangle"""
+    p = origins.astype(np.float64)
+    a = verts[tris[:, 0]].astype(np.float64)
+    ab = verts[tris[:, 1]] - a
+    ac = verts[tris[:, 2]] - a
+    ap = p - a
+    # Barycentric coordinates of the origin inside the triangle projected onto the XY plane
+    det = ab[:, 0] * ac[:, 1] - ac[:, 0] * ab[:, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w1 = (ap[:, 0] * ac[:, 1] - ac[:, 0] * ap[:, 1]) / det
+        w2 = (ab[:, 0] * ap[:, 1] - ap[:, 0] * ab[:, 1]) / det
+        dist = w1 * ab[:, 2] + w2 * ac[:, 2] - ap[:, 2]
+        inside = (w1 >= 0) & (w2 >= 0) & (w1 + w2 <= 1)
+    # Vertical triangles (det == 0) are parallel to the rays and can not be hit
+    return (det != 0) & inside & (dist > 0) & (dist <= RAY_LENGTH)
+
+
+def cast_rays_grid(origins: np.ndarray, directions: np.ndarray, verts: np.ndarray, tris: np.ndarray) -> np.ndarray:
+    """Casts upward rays (all directions must point along the z-axis) and returns a mask (uint8) of all rays that hit
+    the mesh. Every ray only gets tested against the triangles overlapping the grid cell of its origin. Returns None
+    without casting any ray if the triangle density is too uneven for the grid"""
+    hit = np.zeros(len(origins), dtype=np.uint8)
+    if len(tris) == 0 or len(origins) == 0:
+        return hit
+    xy_min, cell_size, shape, cell_min, cell_max, _ = _triangle_cells(verts, tris)
+    count_cells = int(shape[0] * shape[1])
+
+    # Listing the triangles of every cell, the triangles of cell c are cell_tris[cell_start[c]:cell_start[c + 1]]
+    span = cell_max - cell_min + 1
+    counts = span[:, 0] * span[:, 1]
+    pair_tris = np.repeat(np.arange(len(tris)), counts)
+    offsets = np.arange(len(pair_tris)) - np.repeat(np.cumsum(counts) - counts, counts)
+    pair_cells = ((cell_min[pair_tris, 0] + offsets % span[pair_tris, 0]) * shape[1] +
+                  cell_min[pair_tris, 1] + offsets // span[pair_tris, 0])
+    cell_tris = pair_tris[np.argsort(pair_cells, kind="stable")]
+    cell_start = np.zeros(count_cells + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pair_cells, minlength=count_cells), out=cell_start[1:])
+    del pair_tris, offsets, pair_cells
+
+    # Pairs of rays and the cells they have to check, rays starting on a cell border check all adjacent cells
+    cell_low, cell_high, outside = _ray_cells(origins, xy_min, cell_size, shape)
+    ray_ids = np.arange(len(origins))
+    border_x = cell_low[:, 0] != cell_high[:, 0]
+    border_y = cell_low[:, 1] != cell_high[:, 1]
+    ray_cells = []
+    for use, cx, cy in ((~outside, cell_high[:, 0], cell_high[:, 1]),
+                        (~outside & border_x, cell_low[:, 0], cell_high[:, 1]),
+                        (~outside & border_y, cell_high[:, 0], cell_low[:, 1]),
+                        (~outside & border_x & border_y, cell_low[:, 0], cell_low[:, 1])):
+        ray_cells.append(np.stack([ray_ids[use], cx[use] * shape[1] + cy[use]], axis=1))
+    ray_cells = np.concatenate(ray_cells)
+    cell_counts = cell_start[ray_cells[:, 1] + 1] - cell_start[ray_cells[:, 1]]
+    pair_ends = np.cumsum(cell_counts)
+    if len(pair_ends) == 0:
+        return hit
+
+    # The cell size is based on the median triangle, so small and dense details end up in a few cells. Every ray inside
+    # of them would test all of their triangles, the BVH handles these meshes in a fraction of the time
+    mean_count = cell_start[-1] / max(1, np.count_nonzero(np.diff(cell_start)))
+    if pair_ends[-1] > GRID_MAX_DENSITY_FACTOR * mean_count * len(ray_cells):
+        return None
+
+    # Testing the rays in chunks of about GRID_CHUNK_SIZE ray-triangle pairs, the pairs of all rays might not fit into
+    # memory. Every chunk contains at least one ray, even if its cell contains more triangles
+    start = 0
+    while start < len(ray_cells):
+        limit = pair_ends[start] - cell_counts[start] + GRID_CHUNK_SIZE
+        end = max(start + 1, int(np.searchsorted(pair_ends, limit, side="right")))
+        chunk_cells = ray_cells[start:end]
+        chunk_counts = cell_counts[start:end]
+        pair_entries = np.repeat(np.arange(len(chunk_cells)), chunk_counts)
+        offsets = np.arange(len(pair_entries)) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        pair_rays = chunk_cells[pair_entries, 0]
+        pair_tris = cell_tris[cell_start[chunk_cells[pair_entries, 1]] + offsets]
+        hit[pair_rays[_vertical_hits(origins[pair_rays], verts, tris[pair_tris])]] = 1
+        start = end
+    return hit
+
+
+def select_faces(mesh_obj: bpy_types.Mesh, indices: list):
+    """Selects the faces with the given indices together with their edges and vertices. The existing selection is kept.
+    Only works in object mode"""
+    new_faces = np.zeros(len(mesh_obj.polygons), dtype=bool)
+    new_faces[indices] = True
+    loop_totals = np.empty(len(mesh_obj.polygons), dtype=np.int32)
+    mesh_obj.polygons.foreach_get("loop_total", loop_totals)
+    # The loops are stored ordered by their face
+    new_loops = np.repeat(new_faces, loop_totals)
+    for elements, loop_attr in ((mesh_obj.polygons, None), (mesh_obj.vertices, "vertex_index"),
+                                (mesh_obj.edges, "edge_index")):
+        selected = np.empty(len(elements), dtype=bool)
+        elements.foreach_get("select", selected)
+        if loop_attr is None:
+            selected |= new_faces
+        else:
+            loop_elements = np.empty(len(mesh_obj.loops), dtype=np.int32)
+            mesh_obj.loops.foreach_get(loop_attr, loop_elements)
+            selected[loop_elements[new_loops]] = True
+        elements.foreach_set("select", selected)
+    mesh_obj.update()
+
+
 log("Switching to edit mode")
 bpy.ops.object.mode_set(mode="EDIT")
+# The mesh data only gets updated when leaving edit mode. If the script is started in edit mode, changes made there
+# (selection, added or removed faces) have to be written to the mesh before reading any arrays from it
+obj.update_from_editmode()
 
 # Find debug faces (selected faces)
 if DEBUG:
-    debug_faces = []
+    debug_faces = set()
     for face in mesh.polygons:
         if face.select:
-            debug_faces.append(face.index)
+            debug_faces.add(face.index)
     if len(debug_faces) < 100:
-        log("Debug faces: ", debug_faces)
+        log("Debug faces: ", sorted(debug_faces))
     elif len(debug_faces) > 10000:
         raise ValueError("To many faces selected for debug mode")
 else:
     debug_faces = None
 to_select = []  # Faces that should get selected
-to_create = []  # Objects to create
+# Positions (local coordinates) of the debug primitives to create
+debug_cubes = []
+debug_spheres = []
+debug_tori = []
 
 count_vertex = len(mesh.vertices)
 count_edges = len(mesh.edges)
 count_faces = len(mesh.polygons)
 
 bm = bmesh.from_edit_mesh(mesh)
-my_tree0 = BVHTree.FromBMesh(bm)
+# Snapshot of all faces, ordered by their index. Unlike bm.faces, it does not need a lookup table for index access
+bm_faces = bm.faces[:]
+if len(bm_faces) != count_faces:
+    raise RuntimeError("Mesh data is out of sync with the edit mesh")
 
 if vert_offset:
     # Converting vertical offset to local coordinates
     vert_offset = vert_offset @ mat
 
-i = 0
-deleted = 0
 log(f"Starting cleanup for {mesh_name} ({count_faces} faces to check)")
-bm.faces.ensure_lookup_table()
 
 if MODE == "VERTICAL":
     # Converting vertical direction to local coordinates
     vert_vector = vert_vector @ mat
 
-# noinspection PyTypeChecker
-for face in bm.faces:  # type: bmesh.types.BMFace
-    i += 1
-    if ONLY_SELECTED_FACES and not face.select:
-        continue
-    # Center of face
-    pos = face.calc_center_median()
-    if SKIP_EDGES and is_edge(mat @ pos):
-        continue
-    # Adjusting position to prevent the ray from intersecting with the emitting face itself
-    # and calculating direction for ray
-    if MODE == "NORMAL":
-        nor = face.normal
-        nor.normalize()
-        pos = pos + nor * 0.1
-    elif MODE == "VERTICAL":
-        # Convert to local coordinates
-        nor = vert_vector
-        pos = pos + vert_offset
-    else:
-        raise TypeError(f"Unexpected literal for MODE: '{MODE}'")
+# Fetching all face centers with a single call instead of calculating them face by face
+centers = np.empty((count_faces, 3), dtype=np.float32)
+mesh.polygons.foreach_get("center", centers.ravel())
+
+# Filtering the faces that should get checked
+candidates = np.ones(count_faces, dtype=bool)
+if ONLY_SELECTED_FACES:
+    selected = np.empty(count_faces, dtype=bool)
+    mesh.polygons.foreach_get("select", selected)
+    candidates &= selected
+if SKIP_EDGES:
+    mat_np = np.array(mat, dtype=np.float32)
+    candidates &= ~is_edge(centers @ mat_np[:3, :3].T + mat_np[:3, 3])
+
+# Adjusting position to prevent the ray from intersecting with the emitting face itself
+# and calculating direction for rays
+if MODE == "VERTICAL":
+    centers += np.asarray(vert_offset, dtype=np.float32)
+    # The backends expect unit directions, the distance limit of Embree and numba would be scaled otherwise
+    directions = np.array([vert_vector.normalized()], dtype=np.float32)
+elif MODE == "NORMAL":
+    directions = np.empty_like(centers)
+    mesh.polygons.foreach_get("normal", directions.ravel())
+    lengths = np.linalg.norm(directions, axis=1, keepdims=True)
+    # Degenerated faces have no normal and therefore no ray to cast
+    candidates &= lengths[:, 0] > 0
+    lengths[lengths == 0] = 1
+    directions /= lengths
+    centers += directions * 0.1
+else:
+    raise TypeError(f"Unexpected literal for MODE: '{MODE}'")
 
-    # Casting ray
-    r_pos, p_nor, p_i, p_dist = my_tree0.ray_cast(pos, nor, RAY_LENGTH)
-    if DEBUG and DEBUG_OBJECTS and face.index in debug_faces:
-        to_create.append((pos, (pos + nor), r_pos))
+
+def _debug_ray(face_index: int, pos, nor, r_pos, p_i, p_dist):
+    if face_index not in debug_faces:
+        return
+    # Vectors are only created for the selected faces, all other rays are skipped without any allocation
+    pos = Vector(pos)
+    if DEBUG_OBJECTS:
+        debug_cubes.append(pos)
+        debug_spheres.append(pos + Vector(nor))
+        if r_pos is not None:
+            debug_tori.append(r_pos)
     if r_pos is not None:
-        if not DEBUG:
-            bm.faces.remove(face)
-            deleted += 1
-        else:
-            if face.index in debug_faces:
-                log(f"Found debug face {i}, hit {p_i}, distance {p_dist:.2f}")
-                log(pos, r_pos)
-                to_select.append(p_i)
-    if i % 30000 == 0:
-        progress = i / count_faces
-        log(f"{progress:4.1%} Processed {i:,} faces, deleted {deleted:,}")
+        # The tree is built from triangles, p_i is the index of the triangle
+        hit_face = int(tri_faces[p_i])
+        log(f"Found debug face {face_index}, hit {hit_face}, distance {p_dist:.2f}")
+        log(pos, r_pos)
+        to_select.append(hit_face)
 
-if DEBUG:
-    if len(to_select) == 0:
-        log("No faces hit")
+
+LOG_INTERVAL = 30000
+
+
+def _log_progress(i: int, count: int, hits: int):
+    log(f"{i / count:4.1%} Processed {i:,} faces, deleted {hits:,}")
+
+
+# The loops below pass plain python lists to ray_cast (it accepts any sequence), this saves the conversion of every
+# single numpy row and the creation of Vector objects. The rows get converted one slice of LOG_INTERVAL faces at a
+# time, a list of python floats needs more than ten times the memory of the numpy array
+def _loop_vertical(tree: BVHTree, indices: list, origins: np.ndarray, directions: np.ndarray) -> np.ndarray:
+    """Casts vertical rays (directions contains only the one vertical direction) from the origins of the given faces.
+    Returns a mask (uint8) of all rays that hit the mesh (always empty in debug mode)"""
+    ray_cast = tree.ray_cast
+    # One Vector instance shared by all rays, ray_cast reads a Vector faster than a list
+    direction = Vector(directions[0])
+    count = len(indices)
+    hits = np.zeros(count, dtype=np.uint8)
+    hit_count = 0
+    for start in range(0, count, LOG_INTERVAL):
+        slice_indices = indices[start:start + LOG_INTERVAL]
+        for i, (face_index, pos) in enumerate(zip(slice_indices, origins[slice_indices].tolist()), start):
+            r_pos, p_nor, p_i, p_dist = ray_cast(pos, direction, RAY_LENGTH)
+            if DEBUG:
+                _debug_ray(face_index, pos, direction, r_pos, p_i, p_dist)
+            elif r_pos is not None:
+                hits[i] = 1
+                hit_count += 1
+        if len(slice_indices) == LOG_INTERVAL:
+            _log_progress(start + LOG_INTERVAL, count, hit_count)
+    return hits
+
+
+def _loop_normal(tree: BVHTree, indices: list, origins: np.ndarray, directions: np.ndarray) -> np.ndarray:
+    """Casts rays into the normal direction (one direction per face) from the origins of the given faces. Returns a
+    mask (uint8) of all rays that hit the mesh (always empty in debug mode)"""
+    ray_cast = tree.ray_cast
+    count = len(indices)
+    hits = np.zeros(count, dtype=np.uint8)
+    hit_count = 0
+    for start in range(0, count, LOG_INTERVAL):
+        slice_indices = indices[start:start + LOG_INTERVAL]
+        rows = zip(slice_indices, origins[slice_indices].tolist(), directions[slice_indices].tolist())
+        for i, (face_index, pos, nor) in enumerate(rows, start):
+            r_pos, p_nor, p_i, p_dist = ray_cast(pos, nor, RAY_LENGTH)
+            if DEBUG:
+                _debug_ray(face_index, pos, nor, r_pos, p_i, p_dist)
+            elif r_pos is not None:
+                hits[i] = 1
+                hit_count += 1
+        if len(slice_indices) == LOG_INTERVAL:
+            _log_progress(start + LOG_INTERVAL, count, hit_count)
+    return hits
+
+
+face_indices = np.flatnonzero(candidates)
+verts, tris, tri_faces = mesh_triangles(mesh)
+vertical_up = MODE == "VERTICAL" and is_upwards(directions[0])
+use_numba = USE_NUMBA and numba_available and not DEBUG
+use_embree = USE_EMBREE and embree_available and not DEBUG and not use_numba
+use_grid = USE_HEIGHT_GRID and vertical_up and not DEBUG and not use_numba and not use_embree
+# Only mention a missing backend if it would have been chosen, the later ones in the chain would be skipped anyway
+if USE_NUMBA and not numba_available and not DEBUG:
+    log("Numba not found")
+if USE_EMBREE and not embree_available and not DEBUG and not use_numba:
+    log("Embreex not found")
+hit_mask = None
+if use_grid:
+    log(f"Casting {len(face_indices):,} rays with the height grid")
+    hit_mask = cast_rays_grid(centers[face_indices], directions, verts, tris)
+    if hit_mask is None:
+        log("The triangle density is too uneven for the height grid, casting the rays with the BVHTree instead")
+if hit_mask is None:
+    # The height grid only tests the triangles of the cell of each ray anyway, the rays only get culled for the BVHs
+    if vertical_up and not DEBUG:
+        reachable = cull_vertical_rays(centers[face_indices], verts, tris)
+        log(f"Skipping {np.count_nonzero(~reachable):,} faces that are above all other faces")
+        face_indices = face_indices[reachable]
+    count_checked = len(face_indices)
+    if use_numba or use_embree:
+        backend, cast_rays = ("numba", cast_rays_numba) if use_numba else ("Embree", cast_rays_embree)
+        log(f"Casting {count_checked:,} rays with {backend}")
+        if MODE == "NORMAL":
+            directions = directions[face_indices]
+        hit_mask = cast_rays(centers[face_indices], directions, verts, tris)
     else:
-        log(f"Selecting faces ", to_select)
-        for face in to_select:
-            bm.faces[face].select = True
-            log(f"Selected face ", face)
+        # Building the tree from the triangle arrays is faster than reading the geometry from the BMesh. The
+        # coordinates get converted to python floats for the call, the tree itself stores them with 32 bit precision
+        my_tree0 = BVHTree.FromPolygons(verts.tolist(), tris.tolist(), all_triangles=True, epsilon=0.0)
+        # Selecting the loop once instead of checking the mode for every face
+        loop = _loop_vertical if MODE == "VERTICAL" else _loop_normal
+        hit_mask = loop(my_tree0, face_indices.tolist(), centers, directions)
+        # Freeing the tree right away, delete_loose needs a lot of memory for large meshes as well
+        del my_tree0
+del verts, tris
+
+# Deleting all hit faces after the loop. Removing them one by one would update the topology for every face and
+# would modify bm.faces while it is in use
+hit_indices = face_indices[hit_mask.view(bool)].tolist()
+deleted = len(hit_indices)
+delete_faces(bm, [bm_faces[index] for index in hit_indices])
 
 bmesh.update_edit_mesh(mesh, destructive=not DEBUG)
 if not DEBUG:
@@ -189,15 +750,16 @@ if not DEBUG:
     bpy.ops.mesh.delete_loose()
 log("Switching to object mode")
 bpy.ops.object.mode_set(mode="OBJECT")
+if DEBUG:
+    if len(to_select) == 0:
+        log("No faces hit")
+    else:
+        log(f"Selecting {len(set(to_select)):,} faces")
+        select_faces(mesh, to_select)
 if DEBUG_OBJECTS:
-    if DEBUG:
-        if len(to_create) > 0:
-            log(f"Creating {len(to_create)} debug objects")
-        if len(to_create) > 20:
+    if DEBUG and len(debug_cubes) > 0:
+        log(f"Creating {len(debug_cubes)} debug rays")
+        if len(debug_cubes) > 20:
             raise RuntimeError("Canceling debug object creation: To many objects")
-        for pos, p_n, r_pos in to_create:
-            bpy.ops.mesh.primitive_cube_add(location=mat @ pos, size=0.5)
-            bpy.ops.mesh.primitive_ico_sphere_add(location=mat @ p_n, scale=(0.2, 0.2, 0.2))
-            if r_pos is not None:
-                bpy.ops.mesh.primitive_torus_add(location=mat @ r_pos, major_radius=0.5)
+        create_debug_object(f"{mesh_name}_debug")
 log("Cleanup completed")